@@ -7,7 +7,7 @@ The clustering algorithm works in several steps to generate cluster assignments.
 2. Cluster on the scoring matrix.
 3. In case the network displays memory effects, define weak nodes.
 
-The scoring matrix is first clustered with the AgglomerativeClustering algorithm.
+The scoring matrix is first clustered with agglomerative clustering (Ward linkage).
 Because the network flow strategy can result in central values being separated from the clusters,
 agglomerative clustering is repeated on score matrices with removed high-scoring nodes
 until larger clusters are identified.
@@ -28,7 +28,7 @@ __license__ = 'Apache 2.0'
 import networkx as nx
 import numpy as np
 # from sklearn.mixture import GaussianMixture  #  This works quite well, slightly better Sn
-from sklearn.cluster import AgglomerativeClustering
+from scipy.cluster.hierarchy import linkage, cut_tree
 import sys
 from manta.flow import partial_diffusion, diffusion, harary_components
 from itertools import combinations, chain
@@ -83,10 +83,8 @@ def cluster_graph(graph, limit, max_clusters, min_clusters, min_cluster_size,
     :param verbose: Verbosity level of function
     :return: NetworkX graph, score matrix and diffusion matrix.
     """
-    adj_index = dict()
-    for i in range(len(graph.nodes)):
-        adj_index[list(graph.nodes)[i]] = i
-    rev_index = {v: k for k, v in adj_index.items()}
+    adj_index = {node: i for i, node in enumerate(graph.nodes)}
+    rev_index = {i: node for i, node in enumerate(graph.nodes)}
     # next part is to define scoring matrix
     balanced = [False]
     scoremat, memory, diffs = diffusion(graph=graph, limit=limit, iterations=iterations, verbose=verbose)
@@ -150,39 +148,33 @@ def sparsity_score(graph, clusters, rev_index):
     # all negative edges inside clusters and positive outside clusters
     # 1 is the best,
     # with clusters containing only positive edges
-    cut_score = 1/len(graph.edges)
-    sparsity = 0
-    edges = list()
-    for cluster_id in set(clusters):
-        # get the set of edges that is NOT in either cluster
-        node_ids = list(np.where(clusters == cluster_id)[0])
-        node_ids = [rev_index.get(item, item) for item in node_ids]
-        cluster = graph.subgraph(node_ids)
-        edges.extend(list(cluster.edges))
-        # penalize for having negative edges inside cluster
-        weights = nx.get_edge_attributes(cluster, 'weight')
-        for x in weights:
-            if weights[x] < 0:
-                sparsity -= cut_score
-            else:
-                sparsity += cut_score
-    all_edges = list(graph.edges)
-    cuts = list()
-    for edge in all_edges:
-        if edge not in edges and (edge[1], edge[0]) not in edges:
-            # problem with cluster edges having swapped orders
-            cuts.append(edge)
-    for edge in cuts:
-        cut = graph[edge[0]][edge[1]]['weight']
-        if cut > 0:
-            sparsity -= cut_score
-        else:
-            sparsity += cut_score
+    # edges are counted on a weight matrix ordered by the matrix index;
+    # absent edges are set to nan so zero-weighted edges are still counted
+    nodes = [rev_index[i] for i in range(len(rev_index))]
+    weights = nx.to_numpy_array(graph, nodelist=nodes, nonedge=np.nan)
+    if not nx.is_directed(graph):
+        # each undirected edge should only be counted once
+        weights[np.tril_indices(len(nodes), -1)] = np.nan
+    # edge signs are 1 for positive edges, -1 for negative edges
+    # and 0 for zero-weighted or absent edges
+    signs = np.sign(np.nan_to_num(weights))
+    # one-hot matrix of cluster assignments, row i marks the cluster of node i
+    cluster_ids, labels = np.unique(clusters, return_inverse=True)
+    onehot = np.zeros((len(nodes), len(cluster_ids)))
+    onehot[np.arange(len(labels)), labels] = 1
+    # sum of edge signs inside clusters, for all clusters at once
+    inside = np.sum(onehot * (signs @ onehot))
+    # all edges that are not inside a cluster are cut
+    cut = np.sum(signs) - inside
+    # penalize for having negative edges inside cluster
+    # and for cutting through positive edges
+    # zero-weighted edges are rewarded both inside clusters and when cut
+    sparsity = float((inside - cut + np.sum(weights == 0)) / len(graph.edges))
     return sparsity
 
 
 def cluster_hard(graph, adj_index, rev_index, scoremat,
-                 max_clusters, min_clusters, min_cluster_size, verbose):
+                 max_clusters, min_clusters, min_cluster_size, verbose, patience=2):
     """
     Agglomerative clustering is used to separate nodes based on the scoring matrix.
     Because the scoring matrix generally results in separation of 'central' nodes,
@@ -199,6 +191,8 @@ def cluster_hard(graph, adj_index, rev_index, scoremat,
     :param min_clusters: Minimum cluster number
     :param min_cluster_size: Minimum cluster size as fraction of network size
     :param verbose: Verbosity level of function
+    :param patience: Number of cluster numbers without improved sparsity before the search is stopped;
+    with the default range of 2 to 4 clusters, no cluster number is skipped
     :return: Dictionary of nodes with cluster assignments
     """
     # get the mean of 100 assignments
@@ -215,11 +209,25 @@ def cluster_hard(graph, adj_index, rev_index, scoremat,
     scoremat_index = rev_index.copy()
     outliers = dict()
     outliers[clusnum] = list()
-    clustermat = scoremat.copy()
+    # the clustering matrix is never changed in place,
+    # so the scoring matrix does not need to be copied
+    clustermat = scoremat
+    # the Ward tree only depends on the clustering matrix,
+    # so it is built once and cut for every cluster number
+    # until the clustering matrix changes
+    # the tree of the full scoring matrix is kept for every reset
+    full_tree = linkage(scoremat, method='ward')
+    tree = full_tree
     # minimum cluster size is 10% of nodes
     minclus = len(graph) * min_cluster_size
+    # the search over cluster numbers stops early
+    # if the sparsity score has not improved for several cluster numbers
+    best_score = -np.inf
+    stale = 0
     while clusnum < max_clusters + 1:
-        clusters = AgglomerativeClustering(n_clusters=clusnum).fit_predict(clustermat)
+        if tree is None:
+            tree = linkage(clustermat, method='ward')
+        clusters = cut_tree(tree, n_clusters=clusnum).flatten()
         counts = np.bincount(clusters)
         # then add to cluster based on shortest paths
         if len(np.where(counts > (minclus / clusnum))[0]) < 2:
@@ -240,25 +248,38 @@ def cluster_hard(graph, adj_index, rev_index, scoremat,
             # outlier nodes are added to a list, to be dealt with later
             outliers[clusnum].append(scoremat_index[clusloc])
             clustermat, scoremat_index = _remove_node(clusloc, clustermat, scoremat_index)
+            tree = None
             # now the smaller clusters are deleted, we can cluster on the updated scoring matrix
             if clustermat.shape[0] <= max_clusters:
                 # indicates that there is no good clustering possible for this cluster number
                 clusnum += 1
                 outliers[clusnum] = list()
                 # reset scoring matrix in case different cluster assignment does assign outliers
-                clustermat = scoremat.copy()
+                clustermat = scoremat
                 scoremat_index = rev_index.copy()
+                tree = full_tree
         else:
             scores[clusnum] = sparsity_score(graph, clusters, rev_index)
             bestclusters[clusnum] = clusters
             if verbose:
                 logger.info('Sparsity level of k=' + str(clusnum) + ' clusters: '
                             + str(scores[clusnum]) + '.')
+            if scores[clusnum] > best_score:
+                best_score = scores[clusnum]
+                stale = 0
+            else:
+                stale += 1
+            if stale >= patience:
+                if verbose:
+                    logger.info('Sparsity level did not improve for ' + str(patience) +
+                                ' cluster numbers, stopping at k=' + str(clusnum) + '.')
+                break
             clusnum += 1
             outliers[clusnum] = list()
             # reset scoring matrix in case different cluster assignment does assign outliers
-            clustermat = scoremat.copy()
+            clustermat = scoremat
             scoremat_index = rev_index.copy()
+            tree = full_tree
     topscore = max(scores, key=scores.get)
     if topscore != 'random':
         if verbose:
@@ -270,12 +291,14 @@ def cluster_hard(graph, adj_index, rev_index, scoremat,
         # it is possible that all evaluated cluster assignments did not work out
         # in that case, the assignment below is without the binning strategy
         if min_clusters not in bestclusters:
-            bestclusters[min_clusters] = AgglomerativeClustering(n_clusters=min_clusters).fit_predict(clustermat)
+            if tree is None:
+                tree = linkage(clustermat, method='ward')
+            bestclusters[min_clusters] = cut_tree(tree, n_clusters=min_clusters).flatten()
     # given a topscore, clustering is carried out on scoremat without outliers
+    # labels for the topscore were stored during the sweep,
+    # so only the matrix index needs to be updated for the outliers
     outlier_locs = [adj_index[x] for x in outliers[topscore]]
-    scoremat_index = rev_index.copy()
-    clustermat = scoremat.copy()
-    clustermat, scoremat_index = _remove_node(outlier_locs, clustermat, scoremat_index)
+    scoremat_index = _remove_index(outlier_locs, rev_index.copy())
     bestcluster = bestclusters[topscore]
     # we need to assign outlier nodes to clusters after clustering on main network
     corrdict = _path_weights(outliers[topscore], graph, verbose)
@@ -536,29 +559,30 @@ def _path_weights(source, graph, verbose):
     :return: Dictionary of shortest path weights
     """
     corrdict = dict.fromkeys(source)
-    weights = nx.get_edge_attributes(graph, 'weight')
-    max_weight = max(weights.values())
-    weights = {k: v / max_weight for k, v in weights.items()}
-    rev_weights = dict()
-    for key in weights:
-        newkey = (key[1], key[0])
-        rev_weights[newkey] = weights[key]
-    weights = {**weights, **rev_weights}
     # first scale edge weights
+    # the scaled weights are stored per node and neighbour,
+    # so edge weights along a path are looked up through the adjacency
+    # edges without a weight are given weight 1, as in the diffusion process
+    max_weight = max(weight for u, v, weight in graph.edges(data='weight', default=1))
+    weights = {node: {nb: data.get('weight', 1) / max_weight for nb, data in nbrs.items()}
+               for node, nbrs in graph.adjacency()}
     for node in source:
-        targets = list(graph.nodes)
+        # a single breadth-first search gives all shortest paths from the source;
+        # the summed edge products and number of shortest paths are then
+        # propagated from the source outwards, one distance level at a time
+        preds, dists = nx.predecessor(graph, source=node, return_seen=True)
+        path_sums = {node: 1}
+        path_counts = {node: 1}
+        for target in sorted(dists, key=dists.get):
+            if target == node:
+                continue
+            path_sums[target] = sum(path_sums[x] * weights[x][target] for x in preds[target])
+            path_counts[target] = sum(path_counts[x] for x in preds[target])
         corrdict[node] = dict()
-        for target in targets:
-            try:
-                shortest_paths = list(nx.all_shortest_paths(graph, source=node, target=target))
-                total_weight = 0
-                for path in shortest_paths:
-                    edge_weight = 1
-                    for i in range(len(path) - 1):
-                        edge_weight *= weights[(path[i], path[i + 1])]
-                    total_weight += edge_weight
-                total_weight = total_weight / len(shortest_paths)
-            except nx.exception.NetworkXNoPath:
+        for target in graph.nodes:
+            if target in dists:
+                total_weight = path_sums[target] / path_counts[target]
+            else:
                 if verbose:
                     logger.warning("Could not find shortest path for: " + target)
                 total_weight = -1
@@ -578,8 +602,26 @@ def _remove_node(loc, mat, mat_index):
     :param mat_index: Matrix index
     :return: Tuple of  matrix and matrix_index
     """
-    mat = np.delete(mat, loc, axis=0)
-    mat = np.delete(mat, loc, axis=1)
+    # update scoring matrix with removed nodes
+    # rows and columns are removed in a single copy of the matrix
+    keep = np.delete(np.arange(mat.shape[0]), loc)
+    mat = mat[np.ix_(keep, keep)]
+    mat_index = _remove_index(loc, mat_index)
+    return mat, mat_index
+
+
+def _remove_index(loc, mat_index):
+    """
+    Given an outlier node to remove,
+    this function updates the matrix index only.
+    The scoring matrix itself is left untouched.
+
+    Parameters
+    ----------
+    :param loc: Node(s) to remove
+    :param mat_index: Matrix index
+    :return: Matrix index
+    """
     if type(loc) == list:
         loc.sort()
     else:
@@ -593,8 +635,7 @@ def _remove_node(loc, mat, mat_index):
                 mat_index[remainder] = mat_index[remainder + 1]
             mat_index.pop(len(mat_index) - 1)
             loc = [x - 1 for x in loc]
-    # update scoring matrix with removed nodes
-    return mat, mat_index
+    return mat_index
 
 
 def _cluster_vector(assignment, adj_index):
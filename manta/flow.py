@@ -37,7 +37,7 @@ __license__ = 'Apache 2.0'
 
 
 import sys
-from random import sample
+from random import sample, choice
 import networkx as nx
 import numpy as np
 import os
@@ -108,7 +108,7 @@ def diffusion(graph, iterations, limit, verbose, norm=True, inflation=True):
     error_2 = 1  # detects flip-flop effect; normal clusters can also increase in error first
     while error > limit and iters < iterations:
         # if there is no flip-flop state, the error will decrease after convergence
-        updated_mat = np.linalg.matrix_power(scoremat, 2)
+        updated_mat = scoremat @ scoremat
         # updated_mat = deepcopy(scoremat)
         # for entry in np.nditer(updated_mat, op_flags=['readwrite']):
         # entry[...] = entry ** 2
@@ -140,13 +140,13 @@ def diffusion(graph, iterations, limit, verbose, norm=True, inflation=True):
         # this indicates the matrix is busy converging to 0
         # in that case, we do the same as with the memory effect
         if inflation:
-            for value in np.nditer(updated_mat, op_flags=['readwrite']):
-                if value != 0:
-                    # normally, there is an inflation step; values are raised to a power
-                    # with this normalisation, the inflation step causes
-                    # the algorithm to converge to 0
-                    # we need above-0 values to converge to -1, and the rest to 1
-                    value[...] = value + (1/value)
+            # normally, there is an inflation step; values are raised to a power
+            # with this normalisation, the inflation step causes
+            # the algorithm to converge to 0
+            # we need above-0 values to converge to -1, and the rest to 1
+            # the inflation is applied to the full matrix at once, not value by value
+            nonzero = updated_mat != 0
+            updated_mat[nonzero] += 1 / updated_mat[nonzero]
 
         if norm:
             updated_mat = updated_mat / np.max(abs(updated_mat))
@@ -215,24 +215,34 @@ def partial_diffusion(graph, iterations, limit, subset, ratio, permutations, ver
     """
     # scoremat indices are ordered by graph.nodes()
     scoremat = nx.to_numpy_array(graph)
-    mat_index = {list(graph.nodes)[i]: i for i in range(len(graph.nodes))}
+    nodes = list(graph.nodes)
+    mat_index = {node: i for i, node in enumerate(nodes)}
     nums = int(len(graph)*subset)  # fraction of edges in subnetwork set to 0
     # this fraction can be set to 0.8 or higher, gives good results
     # results in file manta_ratio_perm.csv
-    result = list()
     subnum = len(graph)
     if permutations:
         subnum = permutations  # number of subnetworks generated
+    # permutation matrices are only used for their summed values,
+    # so they are stored in single precision to halve their memory use
+    # the array is allocated once and filled per permutation
+    result = np.empty((subnum, len(graph), len(graph)), dtype=np.float32)
+    # signs are counted per permutation on the double precision matrix,
+    # so values that would round to zero in single precision are still counted
+    posfreq = np.zeros((len(graph), len(graph)))
+    negfreq = np.zeros((len(graph), len(graph)))
     b = 0
     while b < subnum:
         # only add 1 to b if below snippet completes
         # otherwise, keep iterating
-        indices = sample(graph.nodes, nums)
-        num_indices = [mat_index[i] for i in indices]
+        # matrix indices are sampled directly, without copying the node view
+        num_indices = sample(range(len(nodes)), nums)
+        indices = [nodes[i] for i in num_indices]
         subgraph = nx.subgraph(graph, indices)
         # we randomly sample from the nodes and create a subgraph from this
         # this can give multiple connected components
-        balanced = harary_components(subgraph, verbose=False)
+        # components that are too small to be diffused separately are not tested for balance
+        balanced = harary_components(subgraph, verbose=False, min_size=0.1 * len(graph))
         # if there is a balanced component, carry out network flow separately
         balanced_matrix = np.copy(scoremat)
         if any(balanced.values()):
@@ -243,45 +253,42 @@ def partial_diffusion(graph, iterations, limit, subset, ratio, permutations, ver
                     partial_score = diffusion(graph=component, limit=limit,
                                               iterations=iterations, verbose=False)[0]
                     # map score matrix to balanced_matrix
-                    for i in range(partial_score.shape[0]):
-                        for j in range(partial_score.shape[0]):
-                            node_ids = [list(component.nodes)[i],
-                                        list(component.nodes)[j]]
-                            mat_ids = [mat_index[node] for node in node_ids]
-                            balanced_matrix[mat_ids[0], mat_ids[1]] = partial_score[i,j]
+                    # rows and columns of partial_score are ordered by component.nodes
+                    mat_ids = np.array([mat_index[node] for node in component.nodes])
+                    balanced_matrix[np.ix_(mat_ids, mat_ids)] = partial_score
             # carry out 1 step propagation on entire matrix
-        submat = np.copy(scoremat)
-        submat[num_indices, :] = 0
-        submat[:, num_indices] = 0
+        # rows and columns of the sampled nodes are set to 0,
+        # so the squared matrix is only non-zero for the remaining nodes
+        # and can be computed from that block alone
+        keep = np.setdiff1d(np.arange(len(graph)), num_indices)
+        submat = scoremat[np.ix_(keep, keep)]
         # if there is no flip-flop state, the error will decrease after convergence
-        updated_mat = np.linalg.matrix_power(submat, 2)
+        updated_mat = np.zeros(scoremat.shape)
+        updated_mat[np.ix_(keep, keep)] = submat @ submat
         if not np.isnan(updated_mat).any() and not np.max(abs(updated_mat)) == 0:
             # it is possible that a feature reaches nan
             # in this case, iteration is repeated
             updated_mat = updated_mat / np.max(abs(updated_mat))
         else:
+            # only the permutations completed so far are kept
+            result = result[:b]
             break
-        for value in np.nditer(updated_mat, op_flags=['readwrite']):
-            if value != 0:
-                value[...] = value + (1 / value)
+        nonzero = updated_mat != 0
+        updated_mat[nonzero] += 1 / updated_mat[nonzero]
         updated_mat = updated_mat / np.max(abs(updated_mat))
         # the permutation matrix is a combination of balanced components
         # and a propagation step (1-step expansion + inflation)
         updated_mat = updated_mat + balanced_matrix
         # normalize again
         updated_mat = updated_mat / np.max(abs(updated_mat))
-        result.append(updated_mat)
+        posfreq[updated_mat > 0] += 1
+        negfreq[updated_mat < 0] += 1
+        result[b] = updated_mat
         b += 1
         if verbose:
             logger.info("Partial diffusion " + str(b))
-    posfreq = np.zeros((len(graph), len(graph)))
-    negfreq = np.zeros((len(graph), len(graph)))
-    for b in range(subnum):
-        posfreq[result[b] > 0] += 1
-        negfreq[result[b] < 0] += 1
     # we count how many times specific values in matrix have
     # been assigned positive or negative values
-    outcome = np.zeros((len(graph), len(graph)))
     # add pseudo count of 1 to prevent errors with zero divison
     posfreq += 1
     pos_results = np.where((posfreq - negfreq) / posfreq > ratio)
@@ -292,7 +299,7 @@ def partial_diffusion(graph, iterations, limit, subset, ratio, permutations, ver
     # the section below adds only positive values
     # for edges that are stable (negatively)
     outcome = np.zeros((len(graph), len(graph)))
-    for b in range(subnum):
+    for b in range(len(result)):
         pos_sums = result[b][pos_results]
         pos_sums[pos_sums < 0] = 0
         outcome[pos_results] += pos_sums
@@ -303,13 +310,14 @@ def partial_diffusion(graph, iterations, limit, subset, ratio, permutations, ver
     return outcome, result
 
 
-def harary_components(graph, verbose):
+def harary_components(graph, verbose, min_size=1):
     """
     This wrapper for the balance test can accept graphs
     that consist of multiple  connected components.
 
     :param graph: NetworkX graph
     :param verbose: Prints result of test to logger if True
+    :param min_size: Connected components with this number of nodes or fewer are not tested
     :return: Returns a dictionary with connected components as keys;
              components that are balanced have a True value.
     """
@@ -319,7 +327,7 @@ def harary_components(graph, verbose):
         all_components = []
         component_generator = nx.connected_components(graph)
         for component in component_generator:
-            if len(component) > 1:
+            if len(component) > min_size:
                 all_components.append(nx.subgraph(graph, component))
     for component in all_components:
         component_balance[component] = harary_balance(component)
@@ -352,44 +360,31 @@ def harary_balance(graph):
              components that are balanced have a True value.
     """
     # Step 1: Select a spanning tree T
-    balance = True
     tree = nx.algorithms.minimum_spanning_tree(graph)
     marks = dict.fromkeys(tree.nodes)
-    lines = dict.fromkeys(graph.edges)
+    lines = dict.fromkeys(graph.edges, False)
     # Step 2: Root T at an arbitrary point v0
-    root = sample(tree.nodes, 1)
+    root = choice(list(marks))
     # Step 3: Mark v0 positive
-    marks[root[0]] = 1.0
+    marks[root] = 1.0
+    # Step 4-6: Select an unsigned point adjacent in T to a signed point,
+    # until all points are signed
+    # a breadth-first search of T visits every point once,
+    # always from the signed point it is adjacent to
+    for match, unsign in nx.bfs_edges(tree, root):
+        # Step 5: Label the selected point with the product
+        # of the sign of the previously point to which it is
+        # adjacent in T and the sign of the line joining them
+        marks[unsign] = marks[match] * tree[match][unsign]['weight']
+        if (unsign, match) in lines:
+            lines[(unsign, match)] = True
+    # Step 7: Is there a line that has not been tested?
+    # it is possible that all lines have been tested;
+    # in this case, the graph is balanced for sure
     balance = True
-    while not all(lines.values()):
-        # Step 7: Is there a line that has not been tested?
-        while not all(marks.values()):
-            # Step 6: Is there a value that has not been tested?
-            step4 = False
-            while not step4:
-                # Step 4: Select an unsigned point adjacent in T to a signed point
-                # get all unsigned nodes
-                unsigned = [i for i in marks if not marks[i]]
-                # find an unsigned node that is a neighbour of a signed node
-                signed = [i for i in marks if marks[i]]
-                for unsign in unsigned:
-                    match = set(nx.neighbors(tree, unsign)).intersection(signed)
-                    if len(match) > 0:
-                        step4 = True
-                        match = sample(match, 1)[0]
-                        # Step 5: Label the selected point with the product
-                        # of the sign of the previously point to which it is
-                        # adjacent in T and the sign of the line joining them
-                        marks[unsign] = marks[match] * tree[match][unsign]['weight']
-                        try:
-                            lines[(unsign, match)] = True
-                        except KeyError:
-                            lines[(match, unsign)] = True
+    for untested in lines:
         # Step 8: Select an untested line of S - E(T)
-        # it is possible that all lines have been tested;
-        # in this case, the graph is balanced for sure
-        if not all(lines.values()):
-            untested = sample([i for i in lines if not lines[i]], 1)[0]
+        if not lines[untested]:
             # Step 9: Is the sign of the selected line equal to the product
             # of the signs of its two points?
             untested_sign = marks[untested[0]] * marks[untested[1]]
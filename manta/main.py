@@ -36,6 +36,7 @@ Default numeric parameters:
 -rel    Number of permutation iterations for reliability estimates.
         By default, this number is estimated from the number of dyadic pairs.
 -e      Fraction of edges to rewire for reliability tests. Default: 0.1.
+-cores  Number of processes used for reliability permutations. Default: 1.
 
 For demo purposes, we included a network generated from oral samples of bats.
 This data was downloaded from QIITA: https://qiita.ucsd.edu/study/description/11815
@@ -182,8 +183,14 @@ def set_manta():
                         help='Number of permutation iterations for reliability estimates. \n '
                              'By default, this is 20. \n',
                         default=20)
+    parser.add_argument('-cores', '--cores',
+                        dest='cores', type=int,
+                        required=False,
+                        help='Number of processes used for reliability permutations. \n '
+                             'Use 1 for reproducible results. Default: 1.',
+                        default=1)
     parser.add_argument('-e', '--error',
-                        dest='error', type=int,
+                        dest='error', type=float,
                         required=False,
                         help='Fraction of edges to rewire for reliability tests. Default: 0.1.',
                         default=0.1)
@@ -276,7 +283,7 @@ def main():
                       min_clusters=args['min'], min_cluster_size=args['ms'],
                       iterations=args['iter'], ratio=args['ratio'],
                       partialperms=args['perm'], relperms=args['rel'], subset=args['subset'],
-                      error=args['error'], verbose=args['verbose'])
+                      error=args['error'], verbose=args['verbose'], cores=args['cores'])
     layout = None
     if args['bin']:
         for edge in network.edges:
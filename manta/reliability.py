@@ -30,6 +30,7 @@ from manta.flow import diffusion
 from manta.cluster import cluster_graph
 from scipy.stats import binom_test, norm
 from random import choice
+from joblib import Parallel, delayed
 import sys
 import os
 import logging.handlers
@@ -85,9 +86,8 @@ def central_edge(graph, percentile, permutations, error, verbose):
     posthresh = np.percentile(scoremat, 100-percentile)
     neghubs = list(map(tuple, np.argwhere(scoremat <= negthresh)))
     poshubs = list(map(tuple, np.argwhere(scoremat >= posthresh)))
-    adj_index = dict()
-    for i in range(len(graph.nodes)):
-        adj_index[list(graph.nodes)[i]] = i
+    nodes = list(graph.nodes)
+    adj_index = {node: i for i, node in enumerate(nodes)}
     if permutations > 0:
         score = perm_edges(graph, percentile=percentile, permutations=permutations,
                            pos=poshubs, neg=neghubs, error=error)
@@ -98,14 +98,14 @@ def central_edge(graph, percentile, permutations, error, verbose):
     edge_scores = dict()
     # need to convert matrix index to node ID
     for edge in neghubs:
-        node1 = list(graph.nodes)[edge[0]]
-        node2 = list(graph.nodes)[edge[1]]
+        node1 = nodes[edge[0]]
+        node2 = nodes[edge[1]]
         edge_vals[(node1, node2)] = 'negative hub'
         if permutations > 0 and score is not None:
             edge_scores[(node1, node2)] = score[(adj_index[node1], adj_index[node2])]
     for edge in poshubs:
-        node1 = list(graph.nodes)[edge[0]]
-        node2 = list(graph.nodes)[edge[1]]
+        node1 = nodes[edge[0]]
+        node2 = nodes[edge[1]]
         edge_vals[(node1, node2)] = 'positive hub'
         if permutations > 0 and score is not None:
             edge_scores[(node1, node2)] = score[(adj_index[node1], adj_index[node2])]
@@ -282,40 +282,31 @@ def perm_edges(graph, permutations, percentile, pos, neg, error):
     :param error: Fraction of edges to rewire for reliability metric.
     :return: List of reliability scores.
     """
-    perms = list()
+    # instead of storing every permuted matrix,
+    # the number of permutations where a position is a hub is counted
+    poscounts = np.zeros((len(graph), len(graph)), dtype=int)
+    negcounts = np.zeros((len(graph), len(graph)), dtype=int)
     for i in range(permutations):
         permutation, swapfail = rewire_graph(graph, error)
         if swapfail:
             return
         adj = diffusion(graph=permutation, limit=2, iterations=3, norm=False, verbose=False)[0]
-        perms.append(adj)
+        negthresh = np.percentile(adj, percentile)
+        posthresh = np.percentile(adj, 100 - percentile)
+        poscounts += adj >= posthresh
+        negcounts += adj <= negthresh
         logger.info('Permutation ' + str(i))
-    posmatches = dict()
-    negmatches = dict()
+    reliability = dict()
     for hub in pos:
-        posmatches[hub] = 0
+        reliability[hub] = float(poscounts[hub] / permutations)
     for hub in neg:
-        negmatches[hub] = 0
-    for perm in perms:
-        negthresh = np.percentile(perm, percentile)
-        posthresh = np.percentile(perm, 100 - percentile)
-        permneg = list(map(tuple, np.argwhere(perm <= negthresh)))
-        permpos = list(map(tuple, np.argwhere(perm >= posthresh)))
-        matches = set(pos).intersection(permpos)
-        for match in matches:
-            posmatches[match] += 1
-        matches = set(neg).intersection(permneg)
-        for match in matches:
-            negmatches[match] += 1
-    reliability = posmatches.copy()
-    reliability.update(negmatches)
-    reliability = {k: (v/permutations) for k, v in reliability.items()}
+        reliability[hub] = float(negcounts[hub] / permutations)
     # p value equals number of permutations that exceeds / is smaller than matrix values
     return reliability
 
 
 def perm_clusters(graph, limit, max_clusters, min_clusters, min_cluster_size,
-                  iterations, ratio, partialperms, relperms, subset, error, verbose):
+                  iterations, ratio, partialperms, relperms, subset, error, verbose, cores=1):
     """
     Calls the rewire_graph function and robustness function
     to compute robustness of cluster assignments.
@@ -336,29 +327,19 @@ def perm_clusters(graph, limit, max_clusters, min_clusters, min_cluster_size,
     :param subset: Fraction of edges used in subsetting procedure
     :param error: Fraction of edges to rewire for reliability metric.
     :param verbose: Verbosity level of function
+    :param cores: Number of processes used to cluster permuted graphs. Use 1 for reproducible results.
     :return:
     """
-    assignments = list()
-    rev_assignments = list()
-    for i in range(relperms):
-        permutation, swapfail = rewire_graph(graph, error)
-        if swapfail:
-            return
-        permutation, mat = cluster_graph(graph=permutation, limit=limit, max_clusters=max_clusters,
-                                         min_clusters=min_clusters, min_cluster_size=min_cluster_size,
-                                         iterations=iterations,
-                                         ratio=ratio, edgescale=0, permutations=partialperms,
-                                         subset=subset,
-                                         verbose=False)
-        cluster = nx.get_node_attributes(permutation, 'cluster')
-        # cluster.values() has same order as permutation.nodes
-        assignments.append(cluster)
-        subassignments = dict()
-        for k, v in cluster.items():
-            subassignments.setdefault(v, set()).add(k)
-        rev_assignments.append(subassignments)
-        if verbose:
-            logger.info('Permutation ' + str(i))
+    # every permutation rewires and clusters its own copy of the graph,
+    # so permutations can be clustered in separate processes
+    jobs = (delayed(_perm_cluster)(graph=graph, limit=limit, max_clusters=max_clusters,
+                                   min_clusters=min_clusters, min_cluster_size=min_cluster_size,
+                                   iterations=iterations, ratio=ratio, partialperms=partialperms,
+                                   subset=subset, error=error, index=i, verbose=verbose)
+            for i in range(relperms))
+    assignments = Parallel(n_jobs=cores)(jobs)
+    if any(cluster is None for cluster in assignments):
+        return
     graphclusters = nx.get_node_attributes(graph, 'cluster')
     clusjaccards, nodejaccards, ci_width = robustness(graphclusters, assignments)
     lowerCI = dict()
@@ -374,6 +355,44 @@ def perm_clusters(graph, limit, max_clusters, min_clusters, min_cluster_size,
         logger.info("Completed estimation of node Jaccard similarities across bootstraps.")
 
 
+def _perm_cluster(graph, limit, max_clusters, min_clusters, min_cluster_size,
+                  iterations, ratio, partialperms, subset, error, index, verbose):
+    """
+    Rewires the graph once and returns the cluster assignment of the rewired graph.
+    This helper function carries out a single permutation for perm_clusters.
+
+    Parameters
+    ----------
+    :param graph: NetworkX graph of a microbial association network.
+    :param limit: Percentage in error decrease until matrix is considered converged.
+    :param max_clusters: Maximum number of clusters to evaluate in K-means clustering.
+    :param min_clusters: Minimum number of clusters to evaluate in K-means clustering.
+    :param min_cluster_size: Minimum cluster size as fraction of network size
+    :param iterations: If algorithm does not converge, it stops here.
+    :param ratio: Ratio of scores that need to be positive or negative for a stable edge
+    :param partialperms: Number of permutations for partial diffusion.
+    :param subset: Fraction of edges used in subsetting procedure
+    :param error: Fraction of edges to rewire for reliability metric.
+    :param index: Number of the permutation
+    :param verbose: Verbosity level of function
+    :return: Dictionary of nodes with cluster assignments, or None if rewiring failed
+    """
+    permutation, swapfail = rewire_graph(graph, error)
+    if swapfail:
+        return
+    permutation, mat = cluster_graph(graph=permutation, limit=limit, max_clusters=max_clusters,
+                                     min_clusters=min_clusters, min_cluster_size=min_cluster_size,
+                                     iterations=iterations,
+                                     ratio=ratio, edgescale=0, permutations=partialperms,
+                                     subset=subset,
+                                     verbose=False)
+    cluster = nx.get_node_attributes(permutation, 'cluster')
+    # cluster.values() has same order as permutation.nodes
+    if verbose:
+        logger.info('Permutation ' + str(index))
+    return cluster
+
+
 def robustness(graphclusters, permutations):
     """
     Compares vectors of cluster assignments to estimate cluster-wise robustness
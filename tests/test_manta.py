@@ -10,11 +10,13 @@ __license__ = 'Apache 2.0'
 
 import unittest
 import networkx as nx
-from manta.cluster import cluster_graph, sparsity_score, cluster_weak, cluster_hard, _cluster_vector
-from manta.flow import diffusion, harary_balance, harary_components
-from manta.reliability import central_edge, central_node, rewire_graph, perm_edges
+from manta.cluster import cluster_graph, sparsity_score, cluster_weak, cluster_hard, _cluster_vector, _path_weights
+from manta.flow import diffusion, partial_diffusion, harary_balance, harary_components
+from manta.reliability import central_edge, central_node, rewire_graph, perm_edges, perm_clusters, _perm_cluster
 from manta.layout import generate_layout, generate_tax_weights
 from copy import deepcopy
+from itertools import combinations
+import random
 import numpy as np
 from io import StringIO
 from sklearn.cluster import KMeans
@@ -142,6 +144,26 @@ class TestMain(unittest.TestCase):
         bootmats = perm_edges(g, permutations, percentile, poshubs, neghubs, error=0.1)
         self.assertEqual((len(poshubs) + len(neghubs)), len(bootmats))
 
+    def test_perm_cluster(self):
+        """Checks if a single reliability permutation assigns every node to a cluster. """
+        cluster = _perm_cluster(deepcopy(g), limit, max_clusters, min_clusters, min_cluster_size,
+                                iterations, ratio, permutations, subset, error, index=0, verbose=False)
+        self.assertEqual(set(cluster), set(g.nodes))
+
+    def test_perm_clusters_swapfail(self):
+        """
+        Checks if reliability estimation in separate processes stops
+        when the graph cannot be rewired.
+        """
+        # edges of a complete graph cannot be swapped without creating parallel edges
+        complete = nx.complete_graph(5)
+        nx.set_edge_attributes(complete, values=1.0, name='weight')
+        results = perm_clusters(complete, limit, max_clusters, min_clusters, min_cluster_size,
+                                iterations, ratio, permutations, relperms=2, subset=subset,
+                                error=0.5, verbose=False, cores=2)
+        self.assertIsNone(results)
+        self.assertEqual(nx.get_node_attributes(complete, 'lowerCI'), {})
+
     def test_center_manta(self):
         """
         Checks if the edge between 1 and 2 is identified as a positive hub.
@@ -202,6 +224,36 @@ class TestMain(unittest.TestCase):
         clusters = nx.get_node_attributes(clustered_graph[0], 'cluster')
         self.assertEqual(clusters['OTU_10'], clusters['OTU_6'])
 
+    def test_cluster_hard_patience(self):
+        """
+        Checks whether cluster_hard stops the search over cluster numbers
+        if the sparsity score drops twice, even though it recovers afterwards.
+        """
+        # the scoring matrix separates 5 groups of 4 nodes;
+        # the Ward tree splits C from D and E at k=3, A from B at k=4
+        # and D from E at k=5
+        groups = {'A': (0, 0), 'B': (0, 2), 'C': (20, 6), 'D': (20, 0), 'E': (20, 0.5)}
+        grouped_g = nx.Graph()
+        for group in groups:
+            for u, v in combinations([group + str(i) for i in range(4)], 2):
+                grouped_g.add_edge(u, v, weight=1)
+        # cuts at k=3 and k=4 lower the sparsity score, the cut at k=5 raises it
+        grouped_g.add_edge('A0', 'B0', weight=-1)
+        grouped_g.add_edge('C0', 'D0', weight=1)
+        grouped_g.add_edge('C1', 'D1', weight=1)
+        for i in range(4):
+            grouped_g.add_edge('D' + str(i), 'E' + str(i), weight=-1)
+        adj_index = {node: i for i, node in enumerate(grouped_g.nodes)}
+        rev_index = {i: node for i, node in enumerate(grouped_g.nodes)}
+        scoremat = np.zeros((len(grouped_g), len(grouped_g)))
+        for node in grouped_g.nodes:
+            scoremat[adj_index[node], :2] = groups[node[0]]
+        stopped = cluster_hard(grouped_g, adj_index, rev_index, scoremat, max_clusters=5,
+                               min_clusters=2, min_cluster_size=0.1, verbose=False, patience=2)
+        full = cluster_hard(grouped_g, adj_index, rev_index, scoremat, max_clusters=5,
+                            min_clusters=2, min_cluster_size=0.1, verbose=False, patience=4)
+        self.assertEqual((len(set(stopped.values())), len(set(full.values()))), (2, 5))
+
     def test_default_manta(self):
         """
         Checks whether the main function carries out both clustering and centrality estimates.
@@ -256,6 +308,19 @@ class TestMain(unittest.TestCase):
         null = rewire_graph(g, error)[0]
         self.assertEqual(len(null.edges), len(g.edges))
 
+    def test_path_weights_directed(self):
+        """
+        Checks if shortest path weights follow edge direction
+        and if unweighted edges are given weight 1.
+        """
+        path_g = nx.DiGraph()
+        path_g.add_edge('OTU_1', 'OTU_2', weight=1.0)
+        path_g.add_edge('OTU_2', 'OTU_1', weight=-0.5)
+        path_g.add_edge('OTU_2', 'OTU_3')
+        corrdict = _path_weights(['OTU_1', 'OTU_2'], path_g, verbose=False)
+        self.assertEqual((corrdict['OTU_1']['OTU_2'], corrdict['OTU_2']['OTU_1'],
+                          corrdict['OTU_1']['OTU_3']), (1.0, -0.5, 1.0))
+
     def test_sparsity_score(self):
         """
         Checks whether correct sparsity scores are calculated.
@@ -279,6 +344,22 @@ class TestMain(unittest.TestCase):
         tax_graph = generate_tax_weights(tax_graph, tax)
         self.assertEqual(tax_graph['OTU_1']['OTU_2']['tax_score'], 2)
 
+    def test_partial_diffusion_break(self):
+        """
+        Checks whether partial_diffusion only returns the permutations
+        completed before a subnetwork without remaining paths is sampled.
+        """
+        pairs = nx.Graph()
+        pairs.add_weighted_edges_from([('OTU_1', 'OTU_2', 1),
+                                       ('OTU_3', 'OTU_4', -1),
+                                       ('OTU_5', 'OTU_6', 1)])
+        random.seed(5)
+        scoremat, result = partial_diffusion(pairs, iterations=iterations, limit=limit,
+                                             subset=0.67, ratio=ratio, permutations=10,
+                                             verbose=False)
+        self.assertEqual(result.shape, (3, 6, 6))
+        self.assertFalse(np.isnan(scoremat).any())
+
     def test_harary_balance_true(self):
         """
         Checks whether the harary_balance function correctly returns True.
@@ -293,6 +374,17 @@ class TestMain(unittest.TestCase):
         harary = harary_components(g, verbose=False)
         self.assertTrue(all(harary.values()))
 
+    def test_harary_components_min_size(self):
+        """
+        Checks whether the harary_components function leaves out
+        components with min_size nodes or fewer.
+        """
+        small_g = deepcopy(g)
+        small_g.add_edge('OTU_11', 'OTU_12', weight=-1.0)
+        small_g.add_node('OTU_13')
+        harary = harary_components(small_g, verbose=False, min_size=2)
+        self.assertEqual([set(component.nodes) for component in harary], [set(g.nodes)])
+
     def test_harary_balance_false(self):
         """
         Checks whether the harary_balance function correctly returns False.